@@ -0,0 +1,47 @@
+import argparse
+import json
+import sqlite3
+import sys
+
+from main import CampaignAnalytics
+
+
+def print_rows(title: str, rows: list):
+    """以表格形式打印查询结果"""
+    print(f"\n📊 {title}")
+    print("-" * 60)
+    if not rows:
+        print("  (无数据)")
+        return
+    columns = list(rows[0].keys())
+    print("  " + " | ".join(columns))
+    for row in rows:
+        values = [f"{value:.3f}" if isinstance(value, float) else str(value) for value in row.values()]
+        print("  " + " | ".join(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI地下城主战役数据报表")
+    parser.add_argument("database", help="SQLite数据库路径")
+    parser.add_argument("--report", choices=sorted(CampaignAnalytics.QUERIES), action="append",
+                        help="只输出指定报表，可重复")
+    parser.add_argument("--limit", type=int, default=10, help="每个报表最多显示的行数")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出")
+    args = parser.parse_args()
+
+    try:
+        results = {name: CampaignAnalytics.run_query(args.database, name, args.limit)
+                   for name in args.report or CampaignAnalytics.QUERIES}
+    except (FileNotFoundError, sqlite3.Error) as e:
+        print(f"❌ 无法读取战役数据库: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for name, rows in results.items():
+            print_rows(name, rows)
+
+
+if __name__ == "__main__":
+    main()
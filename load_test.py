@@ -0,0 +1,474 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from typing import Dict, Any, List
+
+try:
+    import resource
+
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+from main import (IntelligentTextAdventureGame, DeepSeekInterface, WorldEventPool, CampaignAnalytics,
+                  SessionStatStore, DEFAULT_WORLD_EVENTS, FALLBACK_RESPONSE)
+
+# 合成行动组合：类别 -> (权重, 候选行动)
+DEFAULT_ACTION_MIX = {
+    "look": (3, ["查看周围", "观察四周的环境", "查看地图"]),
+    "search": (2, ["搜索", "寻找隐藏的宝藏", "搜索附近的灌木丛"]),
+    "attack": (2, ["攻击", "用剑攻击最近的敌人", "战斗"]),
+    "heal": (1, ["喝下治疗药水"]),
+    "move": (1, ["前往山洞", "返回神秘森林的边缘", "走向远处的村庄"]),
+    "creative": (1, ["我尝试模仿鸟叫声来吸引森林中的精灵注意", "我想爬上那棵大树，从高处观察周围的地形"]),
+}
+
+STUB_LOCATIONS = ["山洞", "神秘森林的边缘", "远处的村庄", "废弃的神殿"]
+STUB_ENEMIES = ["哥布林", "野狼", "骷髅战士", "森林巨蛛"]
+STUB_EVENTS = ["远处传来一阵悠扬的笛声", "一群萤火虫从你身边飞过", "路边的石碑微微发光", "一只乌鸦叼走了什么东西"]
+
+# WorldEventPool.generate_events的提示：只有一条用户消息，要求生成若干随机世界事件
+EVENT_PROMPT_PATTERN = re.compile(r'生成(\d+)个简短的随机世界事件')
+
+# 使用列存储时，每次世界时钟对所有会话的恢复量
+WORLD_TICK_REGEN = {"health": 2, "mana": 1}
+
+
+class LatencyModel:
+    def __init__(self, dist: str = "lognormal", mean: float = 1.0, spread: float = 0.5):
+        """
+        模拟LLM响应延迟的分布
+
+        Args:
+            dist: 分布类型 constant / uniform / exponential / lognormal
+            mean: 平均延迟（秒）
+            spread: uniform为半宽（秒），lognormal为sigma，其余分布忽略
+        """
+        if dist not in ("constant", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"未知的延迟分布: {dist}")
+        self.dist = dist
+        self.mean = mean
+        self.spread = spread
+
+    def sample(self, rng: random.Random) -> float:
+        """采样一次延迟"""
+        if self.mean <= 0:
+            return 0.0
+        if self.dist == "constant":
+            return self.mean
+        if self.dist == "uniform":
+            return max(0.0, rng.uniform(self.mean - self.spread, self.mean + self.spread))
+        if self.dist == "exponential":
+            return rng.expovariate(1.0 / self.mean)
+        # 对数正态：选择mu使期望等于mean
+        mu = math.log(self.mean) - self.spread ** 2 / 2
+        return rng.lognormvariate(mu, self.spread)
+
+
+class StubDeepSeekInterface(DeepSeekInterface):
+    def __init__(self, latency: LatencyModel, failure_rate: float = 0.0, malformed_rate: float = 0.0,
+                 seed: int = None, coalesce_temperatures: tuple = ()):
+        """
+        本地桩LLM，只替换上游调用，请求合并等逻辑沿用DeepSeekInterface
+
+        Args:
+            latency: 延迟分布
+            failure_rate: API调用失败的概率（返回与DeepSeekInterface相同的后备文本）
+            malformed_rate: 返回无法解析的JSON的概率
+            seed: 随机种子
+            coalesce_temperatures: 启用请求合并的温度值，与DeepSeekInterface相同
+        """
+        super().__init__(api_key="stub", base_url="stub://local", model="stub",
+                         coalesce_temperatures=coalesce_temperatures)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.malformed = 0
+        self.event_calls = 0
+        self.event_failures = 0
+
+    def create_client(self):
+        """桩接口不需要API客户端"""
+        return None
+
+    def request_completion(self, messages: list, temperature: float) -> str:
+        """模拟一次上游调用；世界事件池的请求单独计数"""
+        event_match = EVENT_PROMPT_PATTERN.search(messages[0]["content"]) if len(messages) == 1 else None
+        with self.lock:
+            delay = self.latency.sample(self.rng)
+            failed = self.rng.random() < self.failure_rate
+            malformed = not failed and self.rng.random() < self.malformed_rate
+            if event_match:
+                self.event_calls += 1
+                self.event_failures += failed or malformed
+                response = self.build_events(int(event_match.group(1)))
+            else:
+                self.calls += 1
+                self.failures += failed
+                self.malformed += malformed
+                response = self.build_response(messages[-1]["content"])
+
+        time.sleep(delay)
+
+        if failed:
+            return FALLBACK_RESPONSE
+        if malformed:
+            if event_match:
+                return '[{"description": "断开的事件'
+            return '{"needs_roll": true, "difficulty": 12, "description": "断开的响应'
+        return response
+
+    def build_events(self, count: int) -> str:
+        """构造合成的世界事件JSON数组"""
+        rng = self.rng
+        events = []
+        for _ in range(count):
+            stat = rng.choice(WorldEventPool.EFFECT_KEYS)
+            events.append({
+                "description": f"{rng.choice(STUB_EVENTS)}。",
+                "effects": {stat: rng.randint(-5, 10)},
+            })
+        return json.dumps(events, ensure_ascii=False)
+
+    def build_response(self, action: str) -> str:
+        """按行动类型构造合成的DM JSON响应"""
+        rng = self.rng
+        effects: Dict[str, Any] = {}
+        if "攻击" in action or "战斗" in action:
+            effects = {"health": -rng.randint(0, 15), "gold": rng.randint(0, 20),
+                       "remove_enemies": [rng.choice(STUB_ENEMIES)]}
+        elif "搜索" in action or "寻找" in action:
+            effects = {"add_items": [rng.choice(["神秘药水", "古老钥匙", "闪亮宝石"])]}
+        elif "前往" in action or "走向" in action or "返回" in action:
+            location = rng.choice(STUB_LOCATIONS)
+            effects = {"location_change": location, "environment_change": f"{location}的景象",
+                       "add_enemies": [rng.choice(STUB_ENEMIES)] if rng.random() < 0.3 else []}
+        elif "药水" in action:
+            effects = {"health": 30, "remove_items": ["治疗药水"]}
+        else:
+            effects = {"mana": rng.randint(-5, 5)}
+
+        if rng.random() < 0.5:
+            return json.dumps({
+                "needs_roll": True,
+                "difficulty": rng.randint(8, 18),
+                "description": "你开始行动。",
+                "success_outcome": "你成功了！",
+                "failure_outcome": "你失败了。",
+                "effects": effects
+            }, ensure_ascii=False)
+        return json.dumps({
+            "needs_roll": False,
+            "direct_outcome": "你完成了这个行动。",
+            "effects": effects
+        }, ensure_ascii=False)
+
+
+def parse_action_mix(spec: str) -> Dict[str, tuple]:
+    """解析 --mix 参数，如 attack=3,search=2,look=1"""
+    if not spec:
+        return DEFAULT_ACTION_MIX
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_ACTION_MIX:
+            raise ValueError(f"未知的行动类别: {name}")
+        mix[name] = (float(weight or 1), DEFAULT_ACTION_MIX[name][1])
+    return mix
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """最近秩百分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def current_rss_mb() -> float:
+    """当前进程常驻内存（MB）"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    if RESOURCE_AVAILABLE:
+        # 非Linux平台退化为峰值内存；macOS单位为字节，Linux为KB
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+    return 0.0
+
+
+class LoadTest:
+    def __init__(self, players: int, turns: int, stub: StubDeepSeekInterface, action_mix: Dict[str, tuple],
+                 think_time: float = 0.0, world_events: bool = False, sample_interval: float = 1.0,
+                 seed: int = None, analytics: CampaignAnalytics = None, stat_store: SessionStatStore = None,
+                 world_tick: float = 0.5):
+        """
+        并发玩家压测
+
+        Args:
+            players: 并发会话数
+            turns: 每个会话的回合数
+            stub: 桩LLM
+            action_mix: 合成行动组合
+            think_time: 玩家两回合之间的思考时间（秒）
+            world_events: 是否推进世界状态；使用列存储时世界事件和恢复也由主机时钟批量结算
+            sample_interval: 内存采样间隔（秒）
+            seed: 随机种子
+            analytics: 所有会话共享的战役数据记录器
+            stat_store: 所有会话共享的数值属性列存储；各回合的数值效果由主机时钟批量结算
+            world_tick: 使用列存储时主机时钟的间隔（秒）
+        """
+        self.players = players
+        self.turns = turns
+        self.stub = stub
+        self.action_mix = action_mix
+        self.think_time = think_time
+        self.world_events = world_events
+        self.sample_interval = sample_interval
+        self.seed = seed
+        self.analytics = analytics
+        self.stat_store = stat_store
+        self.world_tick = world_tick
+        self.world_ticks = 0
+        # 所有会话共享一个事件池，只有一个后台补充线程；列存储模式下事件由主机时钟结算，不需要事件池
+        self.event_pool = WorldEventPool(stub) if world_events and not stat_store else None
+
+        self.lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.deaths = 0
+        self.fallback_turns = 0
+        self.parse_failed_turns = 0
+        self.model_turns = 0
+        self.memory_samples: List[Dict[str, float]] = []
+        self.done = threading.Event()
+        self.sessions_done = threading.Event()
+
+    def pick_action(self, rng: random.Random) -> str:
+        """按权重选择一个合成行动"""
+        categories = list(self.action_mix.values())
+        weights = [weight for weight, _ in categories]
+        _, actions = rng.choices(categories, weights=weights)[0]
+        return rng.choice(actions)
+
+    def run_session(self, index: int):
+        """驱动一个玩家会话"""
+        rng = random.Random(None if self.seed is None else self.seed + index)
+        game = IntelligentTextAdventureGame(deepseek=self.stub, analytics=self.analytics, stat_store=self.stat_store,
+                                            event_pool=self.event_pool, batch_stat_effects=True)
+
+        for _ in range(self.turns):
+            action = self.pick_action(rng)
+            start = time.perf_counter()
+            record = {}
+            try:
+                record = game.process_turn(action)
+                if self.world_events and self.stat_store:
+                    game.update_world_state()
+                elif self.world_events:
+                    game.advance_world()
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+            elapsed = time.perf_counter() - start
+
+            with self.lock:
+                self.latencies.append(elapsed)
+                self.fallback_turns += bool(record.get("fallback"))
+                self.parse_failed_turns += bool(record.get("parse_failed"))
+                self.model_turns += bool(record.get("model_called"))
+                if game.game_state.health <= 0:
+                    self.deaths += 1
+
+            if game.game_state.health <= 0:
+                game.game_state = game.new_game_state()
+            if self.think_time:
+                time.sleep(rng.uniform(0, 2 * self.think_time))
+
+    def sample_memory(self, start: float):
+        """定期采样进程内存和已完成回合数"""
+        while True:
+            with self.lock:
+                completed = len(self.latencies)
+            self.memory_samples.append({
+                "elapsed": round(time.perf_counter() - start, 3),
+                "rss_mb": round(current_rss_mb(), 2),
+                "turns_completed": completed,
+            })
+            if self.done.wait(self.sample_interval):
+                break
+
+    def run_world_clock(self):
+        """
+        主机级时钟：批量结算各会话的回合效果；开启世界事件时再抽取一个事件
+        对所有会话批量结算，并统一恢复
+        """
+        rng = random.Random(self.seed)
+        while not self.sessions_done.wait(self.world_tick):
+            self.stat_store.flush_effects()
+            if self.world_events:
+                event = rng.choice(DEFAULT_WORLD_EVENTS)
+                self.stat_store.apply_world_event(event["effects"])
+                self.stat_store.regenerate(**WORLD_TICK_REGEN)
+            self.world_ticks += 1
+        self.stat_store.flush_effects()
+
+    def run(self) -> Dict[str, Any]:
+        """运行压测并返回报告"""
+        start = time.perf_counter()
+        sampler = threading.Thread(target=self.sample_memory, args=(start,), daemon=True)
+        sampler.start()
+        clock = None
+        if self.stat_store:
+            clock = threading.Thread(target=self.run_world_clock, daemon=True)
+            clock.start()
+
+        # 游戏本身会大量打印，压测期间丢弃
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            with ThreadPoolExecutor(max_workers=self.players) as pool:
+                list(pool.map(self.run_session, range(self.players)))
+
+        self.sessions_done.set()
+        if clock:
+            clock.join()
+        duration = time.perf_counter() - start
+        if self.event_pool:
+            self.event_pool.stop()
+        self.done.set()
+        sampler.join()
+        return self.report(duration)
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        """汇总吞吐量、延迟百分位、后备率和内存"""
+        latencies = sorted(self.latencies)
+        total_turns = len(latencies)
+        calls = self.stub.calls
+        return {
+            "players": self.players,
+            "turns_per_player": self.turns,
+            "total_turns": total_turns,
+            "duration_s": round(duration, 3),
+            "throughput_turns_per_s": round(total_turns / duration, 2) if duration else 0.0,
+            "latency_s": {
+                "p50": round(percentile(latencies, 50), 4),
+                "p90": round(percentile(latencies, 90), 4),
+                "p95": round(percentile(latencies, 95), 4),
+                "p99": round(percentile(latencies, 99), 4),
+                "max": round(latencies[-1], 4) if latencies else 0.0,
+            },
+            "llm_calls": calls,
+            # 本地处理的回合；共享合并请求的回合已计入model_turns，不重复计算
+            "llm_calls_saved": total_turns - self.model_turns,
+            "coalesced_calls": self.stub.coalescing_stats()["calls_saved"],
+            # 按回合统计游戏实际的处理结果，合并请求的一次失败会计入每个共享它的回合
+            "fallback_rate": round(self.fallback_turns / total_turns, 4) if total_turns else 0.0,
+            "parse_failure_rate": round(self.parse_failed_turns / total_turns, 4) if total_turns else 0.0,
+            "api_failures": self.stub.failures,
+            "malformed_responses": self.stub.malformed,
+            # 世界事件池的后台请求不计入上面的回合调用统计
+            "event_pool": {
+                "llm_calls": self.stub.event_calls,
+                "failures": self.stub.event_failures,
+                "generated": self.event_pool.generated if self.event_pool else 0,
+                "served": self.event_pool.served if self.event_pool else 0,
+                "misses": self.event_pool.misses if self.event_pool else 0,
+            },
+            "turn_errors": self.errors,
+            "deaths": self.deaths,
+            "world_ticks": self.world_ticks,
+            "batched_effects": self.stat_store.settled_effects if self.stat_store else 0,
+            "memory": self.memory_samples,
+        }
+
+
+def print_report(report: Dict[str, Any]):
+    """打印可读的压测报告"""
+    print("=" * 60)
+    print(f"📈 压测报告: {report['players']} 名玩家 × {report['turns_per_player']} 回合")
+    print("=" * 60)
+    print(f"总回合数: {report['total_turns']}, 耗时: {report['duration_s']}s")
+    print(f"吞吐量: {report['throughput_turns_per_s']} 回合/秒")
+    latency = report["latency_s"]
+    print(f"回合延迟: p50={latency['p50']}s p90={latency['p90']}s p95={latency['p95']}s "
+          f"p99={latency['p99']}s max={latency['max']}s")
+    print(f"LLM调用: {report['llm_calls']} (本地处理节省 {report['llm_calls_saved']}, "
+          f"请求合并节省 {report['coalesced_calls']})")
+    print(f"后备率: {report['fallback_rate'] * 100:.2f}%, JSON解析失败率: {report['parse_failure_rate'] * 100:.2f}% "
+          f"(上游: API失败 {report['api_failures']}, JSON损坏 {report['malformed_responses']})")
+    print(f"回合异常: {report['turn_errors']}, 角色死亡: {report['deaths']}")
+    pool = report["event_pool"]
+    if pool["llm_calls"]:
+        print(f"世界事件池: 后台调用 {pool['llm_calls']} (失败 {pool['failures']}), "
+              f"生成 {pool['generated']}, 取用 {pool['served']}, 未命中 {pool['misses']}")
+    if report["world_ticks"] or report["batched_effects"]:
+        print(f"主机批量结算: {report['world_ticks']} 次, 回合效果 {report['batched_effects']} 条")
+    print("-" * 60)
+    print("内存 (秒 / RSS MB / 已完成回合):")
+    for sample in report["memory"]:
+        print(f"  {sample['elapsed']:>8.2f}  {sample['rss_mb']:>8.2f}  {sample['turns_completed']:>8}")
+    print("=" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI地下城主并发玩家压测")
+    parser.add_argument("--players", type=int, default=50, help="并发玩家数")
+    parser.add_argument("--turns", type=int, default=20, help="每名玩家的回合数")
+    parser.add_argument("--latency-dist", default="lognormal",
+                        choices=["constant", "uniform", "exponential", "lognormal"], help="桩LLM延迟分布")
+    parser.add_argument("--latency-mean", type=float, default=1.0, help="平均延迟（秒）")
+    parser.add_argument("--latency-spread", type=float, default=0.5, help="uniform半宽或lognormal的sigma")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="API失败概率")
+    parser.add_argument("--malformed-rate", type=float, default=0.02, help="返回损坏JSON的概率")
+    parser.add_argument("--mix", default="", help="行动组合权重，如 attack=3,search=2,look=1")
+    parser.add_argument("--think-time", type=float, default=0.0, help="玩家平均思考时间（秒）")
+    parser.add_argument("--world-events", action="store_true", help="每回合后推进世界状态")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="内存采样间隔（秒）")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+    parser.add_argument("--coalesce", action="store_true", help="桩LLM合并并发的相同请求")
+    parser.add_argument("--analytics-db", default=None, help="把每回合记录写入该SQLite数据库")
+    parser.add_argument("--stat-store", action="store_true", help="会话数值属性使用共享的列存储")
+    parser.add_argument("--world-tick", type=float, default=0.5, help="列存储模式下主机时钟间隔（秒）")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出报告")
+    args = parser.parse_args()
+
+    stub = StubDeepSeekInterface(
+        LatencyModel(args.latency_dist, args.latency_mean, args.latency_spread),
+        failure_rate=args.failure_rate,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+        coalesce_temperatures=(0.8,) if args.coalesce else ()
+    )
+    analytics = CampaignAnalytics(args.analytics_db) if args.analytics_db else None
+    load_test = LoadTest(args.players, args.turns, stub, parse_action_mix(args.mix),
+                         think_time=args.think_time, world_events=args.world_events,
+                         sample_interval=args.sample_interval, seed=args.seed, analytics=analytics,
+                         stat_store=SessionStatStore() if args.stat_store else None, world_tick=args.world_tick)
+    report = load_test.run()
+    if analytics:
+        analytics.close()
+        report["analytics_rows_written"] = analytics.written
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
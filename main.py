@@ -3,7 +3,18 @@ import time
 import sys
 import json
 import re
-from typing import Dict, Any, Optional
+import os
+import queue
+import sqlite3
+import uuid
+from array import array
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
 
 try:
     import openai
@@ -17,10 +28,21 @@ try:
 
     REQUESTS_AVAILABLE = True
 except ImportError:
-    REQUESTS_AVAILABLE = False32
+    REQUESTS_AVAILABLE = False
+
+try:
+    import numpy as np
+
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
 
 
 class GameState:
+    # 数值属性的限制：下限，以及作为上限的属性
+    STAT_LOWER_BOUNDS = {'health': 0, 'mana': 0, 'strength': 1, 'agility': 1, 'intelligence': 1, 'gold': 0}
+    STAT_UPPER_BOUNDS = {'health': 'max_health', 'mana': 'max_mana'}
+
     def __init__(self):
         self.health = 100
         self.max_health = 100
@@ -46,10 +68,728 @@ class GameState:
             "time_of_day": "下午",
             "recent_events": []
         }
+        self.world_graph = WorldGraph()
+        self.world_graph.record(self.location, self.environment, self.enemies, self.npcs, visit=True, described=True)
+
+    def add_stat(self, stat: str, delta: int) -> int:
+        """属性加上变化量并按规则限制，返回新值"""
+        value = max(self.STAT_LOWER_BOUNDS[stat], getattr(self, stat) + int(delta))
+        if stat in self.STAT_UPPER_BOUNDS:
+            value = min(getattr(self, self.STAT_UPPER_BOUNDS[stat]), value)
+        setattr(self, stat, value)
+        return value
+
+    def snapshot_fields(self) -> Dict[str, Any]:
+        """快照需要保存的全部字段"""
+        return vars(self)
+
+    @classmethod
+    def from_snapshot_fields(cls, fields: Dict[str, Any]) -> 'GameState':
+        """由快照字段恢复状态"""
+        state = cls.__new__(cls)
+        state.__dict__.update(fields)
+        return state
+
+
+class SessionStatStore:
+    STATS = ('health', 'max_health', 'mana', 'max_mana', 'strength', 'agility', 'intelligence', 'gold')
+    EFFECT_STATS = ('health', 'mana', 'strength', 'agility', 'intelligence', 'gold')
+    # 与GameState.add_stat相同的限制：下限，以及作为上限的列
+    LOWER_BOUNDS = GameState.STAT_LOWER_BOUNDS
+    UPPER_BOUNDS = GameState.STAT_UPPER_BOUNDS
+
+    def __init__(self, capacity: int = 1024, use_numpy: bool = NUMPY_AVAILABLE):
+        """
+        以列存储(struct of arrays)保存大量会话的数值属性，批量效果、世界事件和恢复
+        对所有会话做向量化运算
+
+        Args:
+            capacity: 初始容量，不足时自动翻倍
+            use_numpy: 是否使用NumPy数组；否则使用标准库array（逐元素运算）
+        """
+        if use_numpy and not NUMPY_AVAILABLE:
+            raise ImportError("需要安装 numpy: pip install numpy")
+        self.use_numpy = use_numpy
+        self.capacity = 0
+        self.size = 0
+        self.free_slots = []
+        self.lock = threading.Lock()
+        self.pending_effects = deque()
+        self.settled_effects = 0
+        self.columns = {stat: self.new_column(0) for stat in self.STATS + ('active',)}
+        self.grow(max(1, capacity))
+
+    def new_column(self, length: int):
+        """创建长度为length的全零列"""
+        if self.use_numpy:
+            return np.zeros(length, dtype=np.int64)
+        return array('q', bytes(8 * length))
+
+    def grow(self, capacity: int):
+        """扩容到capacity"""
+        extra = capacity - self.capacity
+        for stat, column in self.columns.items():
+            if self.use_numpy:
+                self.columns[stat] = np.concatenate([column, self.new_column(extra)])
+            else:
+                column.extend(self.new_column(extra))
+        self.capacity = capacity
+
+    def allocate(self) -> int:
+        """为新会话分配一行，返回行号"""
+        with self.lock:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                if self.size == self.capacity:
+                    self.grow(self.capacity * 2)
+                slot = self.size
+                self.size += 1
+            self.columns['active'][slot] = 1
+            return slot
+
+    def release(self, slot: int):
+        """释放会话占用的行"""
+        with self.lock:
+            self.columns['active'][slot] = 0
+            self.free_slots.append(slot)
+
+    def get(self, slot: int, stat: str) -> int:
+        """读取单个会话的属性"""
+        with self.lock:
+            return int(self.columns[stat][slot])
+
+    def set(self, slot: int, stat: str, value: int):
+        """写入单个会话的属性（按整数存储，两种后端行为一致）"""
+        with self.lock:
+            self.columns[stat][slot] = int(value)
+
+    def add(self, slot: int, stat: str, delta: int) -> int:
+        """在锁内对单个会话的属性加上变化量并按规则限制，返回新值"""
+        with self.lock:
+            self.apply_deltas(stat, [slot], [int(delta)])
+            return int(self.columns[stat][slot])
+
+    def active_slots(self) -> list:
+        """所有正在使用的行号"""
+        active = self.columns['active']
+        if self.use_numpy:
+            return np.flatnonzero(active[:self.size])
+        return [slot for slot in range(self.size) if active[slot]]
+
+    def apply_deltas(self, stat: str, slots, deltas) -> list:
+        """对一列的若干行加上变化量并按规则限制，返回实际变化量（调用方需持有锁，slots不可重复）"""
+        column = self.columns[stat]
+        lower = self.LOWER_BOUNDS[stat]
+        upper = self.columns[self.UPPER_BOUNDS[stat]] if stat in self.UPPER_BOUNDS else None
+
+        if self.use_numpy:
+            old = column[slots]
+            new = np.maximum(old + deltas, lower)
+            if upper is not None:
+                new = np.minimum(new, upper[slots])
+            column[slots] = new
+            return new - old
+
+        changes = []
+        for slot, delta in zip(slots, deltas):
+            old = column[slot]
+            new = max(lower, old + delta)
+            if upper is not None:
+                new = min(upper[slot], new)
+            column[slot] = new
+            changes.append(new - old)
+        return changes
+
+    def apply_effects_batch(self, slots: list, effects: list) -> Dict[str, Any]:
+        """
+        批量应用效果，slots[i]对应effects[i]；同一会话的多条效果先累加再限制
+
+        Returns:
+            {属性: (行号, 实际变化量)}，只包含有变化的属性
+        """
+        per_stat = {}
+        for slot, effect in zip(slots, effects):
+            for stat in self.EFFECT_STATS:
+                delta = effect.get(stat)
+                if delta:
+                    per_stat.setdefault(stat, ([], []))
+                    per_stat[stat][0].append(slot)
+                    per_stat[stat][1].append(int(delta))
+
+        results = {}
+        with self.lock:
+            for stat, (stat_slots, deltas) in per_stat.items():
+                if self.use_numpy:
+                    unique_slots, inverse = np.unique(np.asarray(stat_slots, dtype=np.int64), return_inverse=True)
+                    summed = np.zeros(len(unique_slots), dtype=np.int64)
+                    np.add.at(summed, inverse, deltas)
+                else:
+                    totals = {}
+                    for slot, delta in zip(stat_slots, deltas):
+                        totals[slot] = totals.get(slot, 0) + delta
+                    unique_slots, summed = list(totals), list(totals.values())
+                results[stat] = (unique_slots, self.apply_deltas(stat, unique_slots, summed))
+        return results
+
+    def queue_effects(self, slot: int, effects: Dict[str, int]):
+        """暂存一个会话本回合的效果，由主机调用flush_effects统一结算"""
+        self.pending_effects.append((slot, effects))
+
+    def flush_effects(self) -> Dict[str, Any]:
+        """用一次apply_effects_batch结算所有暂存的效果"""
+        slots, effects = [], []
+        while self.pending_effects:
+            slot, effect = self.pending_effects.popleft()
+            slots.append(slot)
+            effects.append(effect)
+        if not slots:
+            return {}
+        self.settled_effects += len(slots)
+        return self.apply_effects_batch(slots, effects)
+
+    def apply_world_event(self, effects: Dict[str, int], slots: list = None) -> Dict[str, Any]:
+        """把同一世界事件的效果应用到所有（或指定的）会话"""
+        results = {}
+        with self.lock:
+            targets = self.active_slots() if slots is None else slots
+            for stat in self.EFFECT_STATS:
+                delta = effects.get(stat)
+                if delta:
+                    if self.use_numpy:
+                        deltas = np.full(len(targets), int(delta), dtype=np.int64)
+                    else:
+                        deltas = [int(delta)] * len(targets)
+                    results[stat] = (targets, self.apply_deltas(stat, targets, deltas))
+        return results
+
+    def regenerate(self, health: int = 0, mana: int = 0, slots: list = None) -> Dict[str, Any]:
+        """所有（或指定的）会话按固定量恢复生命值和法力值，不超过上限"""
+        return self.apply_world_event({'health': health, 'mana': mana}, slots)
+
+
+def stat_property(stat: str) -> property:
+    """把数值属性映射到SessionStatStore中的一列"""
+
+    def getter(state):
+        return state.stat_store.get(state.slot, stat)
+
+    def setter(state, value):
+        state.stat_store.set(state.slot, stat, value)
+
+    return property(getter, setter)
+
+
+class PooledGameState(GameState):
+    health = stat_property('health')
+    max_health = stat_property('max_health')
+    mana = stat_property('mana')
+    max_mana = stat_property('max_mana')
+    strength = stat_property('strength')
+    agility = stat_property('agility')
+    intelligence = stat_property('intelligence')
+    gold = stat_property('gold')
+
+    def __init__(self, stat_store: SessionStatStore, slot: int = None):
+        """
+        数值属性存放在共享的SessionStatStore中的GameState，其余字段与GameState相同
+
+        Args:
+            stat_store: 共享的列存储
+            slot: 复用已分配的行（如重新开始游戏时），默认分配新行
+        """
+        self.stat_store = stat_store
+        self.slot = stat_store.allocate() if slot is None else slot
+        super().__init__()
+
+    def add_stat(self, stat: str, delta: int) -> int:
+        """通过列存储原子地修改属性，不会与批量世界事件互相覆盖"""
+        return self.stat_store.add(self.slot, stat, delta)
+
+    def snapshot_fields(self) -> Dict[str, Any]:
+        """快照需要保存的全部字段，包括列存储中的数值属性"""
+        fields = dict(vars(self))
+        for stat in SessionStatStore.STATS:
+            fields[stat] = getattr(self, stat)
+        return fields
+
+    @classmethod
+    def from_snapshot_fields(cls, fields: Dict[str, Any]) -> 'PooledGameState':
+        """由快照字段恢复状态，数值属性写回原来的行"""
+        stats = {stat: fields.pop(stat) for stat in SessionStatStore.STATS}
+        state = super().from_snapshot_fields(fields)
+        for stat, value in stats.items():
+            setattr(state, stat, value)
+        return state
+
+
+# 事件池为空或未连接AI时使用的内置世界事件
+DEFAULT_WORLD_EVENTS = [
+    {
+        'description': '天空中突然出现了一道绚丽的彩虹，你感到精神振奋。',
+        'effects': {'mana': 10}
+    },
+    {
+        'description': '一阵神秘的风吹过，带来了远方的消息和一些金币。',
+        'effects': {'gold': 12}
+    },
+    {
+        'description': '你听到远处传来神秘的钟声，感到内心更加坚定。',
+        'effects': {'health': 8}
+    },
+    {
+        'description': '一只美丽的蝴蝶落在你的肩膀上，然后飞向未知的方向。',
+        'effects': {'intelligence': 1}
+    },
+    {
+        'description': '地面上出现了一个小小的魔法光圈，你从中获得了一些力量。',
+        'effects': {'strength': 1}
+    }
+]
+
+WEATHER_OPTIONS = ["晴朗", "多云", "小雨", "起雾", "微风", "星空闪烁"]
+TIME_OPTIONS = ["黎明", "上午", "正午", "下午", "黄昏", "夜晚", "深夜"]
+
+# DeepSeek调用失败时返回的文本
+FALLBACK_RESPONSE = "抱歉，AI暂时无法响应，将使用基础逻辑处理你的行动。"
+
+# 粗略估算，中文约每字0.6个token
+TOKENS_PER_CHAR = 0.6
+
+DICE_TERM_PATTERN = re.compile(r'\s*([+-])?\s*(?:(\d*)[dD](\d+)|(\d+))\s*')
+
+MOVE_ACTION_PATTERN = re.compile(r'^(?:前往|去|回到|返回|走向|走到|移动到)\s*(?P<target>.+?)[。！!.]?$')
+
+
+class WorldGraph:
+    SNAPSHOT_BUCKETS = 32  # 快照按地点名哈希分桶，变化只重建所在的桶
+
+    def __init__(self, max_locations: int = 200):
+        """
+        已访问地点的世界图，缓存每个地点的环境描述、出口以及常驻的敌人和NPC
+
+        Args:
+            max_locations: 最多缓存的地点数量，超出后淘汰最久未访问的地点
+        """
+        self.max_locations = max_locations
+        self.nodes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.clock = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        """查询地点缓存（只有已描述的地点算命中），命中时标记为最近访问"""
+        node = self.nodes.get(name)
+        if node is None or not node["described"]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(name)
+        return node
+
+    def record(self, name: str, environment: str, enemies: list, npcs: list, visit: bool = False,
+               described: bool = None):
+        """
+        记录（或更新）地点的当前状态
+
+        Args:
+            visit: 为True时计入一次到访
+            described: 环境描述是否确实是为该地点生成的；None表示保持原值。
+                未描述的地点沿用的是上一个地点的文本，不能作为缓存使用
+        """
+        node = self.nodes.get(name)
+        if node is None:
+            node = {"exits": [], "visits": 0, "described": False}
+            self.nodes[name] = node
+        if described is not None:
+            node["described"] = described
+        node["environment"] = environment
+        node["enemies"] = list(enemies)
+        node["npcs"] = list(npcs)
+        if visit:
+            node["visits"] += 1
+        self.touch(name)
+        self.evict()
+
+    def touch(self, name: str):
+        """标记为最近访问；last_used让快照不必保存整个访问顺序"""
+        self.clock += 1
+        self.nodes[name]["last_used"] = self.clock
+        self.nodes.move_to_end(name)
+
+    def connect(self, a: str, b: str):
+        """在两个已缓存的地点之间建立双向通路"""
+        if a == b or a not in self.nodes or b not in self.nodes:
+            return
+        if b not in self.nodes[a]["exits"]:
+            self.nodes[a]["exits"].append(b)
+        if a not in self.nodes[b]["exits"]:
+            self.nodes[b]["exits"].append(a)
+
+    def exits(self, name: str) -> list:
+        """返回地点的已知出口"""
+        node = self.nodes.get(name)
+        return list(node["exits"]) if node else []
+
+    def evict(self):
+        """淘汰最久未访问的地点，并从相邻地点的出口中移除"""
+        while len(self.nodes) > self.max_locations:
+            name, node = self.nodes.popitem(last=False)
+            for neighbor in node["exits"]:
+                if neighbor in self.nodes and name in self.nodes[neighbor]["exits"]:
+                    self.nodes[neighbor]["exits"].remove(name)
+
+    def freeze(self, previous: Optional['FrozenWorldGraph'] = None) -> 'FrozenWorldGraph':
+        """
+        生成不可变快照，地点按名称哈希分桶，未变化的桶和地点与上一个快照共享
+
+        一个地点变化时只重建它所在的桶（约 地点数/SNAPSHOT_BUCKETS 项）和桶索引，
+        访问顺序由各地点的last_used恢复，移动到某地点不会影响其他桶。
+        """
+        grouped = [[] for _ in range(self.SNAPSHOT_BUCKETS)]
+        for name, node in self.nodes.items():
+            grouped[hash(name) % self.SNAPSHOT_BUCKETS].append((name, node))
+
+        previous_buckets = previous[0] if previous else (None,) * self.SNAPSHOT_BUCKETS
+        buckets = []
+        for entries, previous_bucket in zip(grouped, previous_buckets):
+            previous_entries = dict((entry[0], entry) for entry in previous_bucket or ())
+            bucket = []
+            for name, node in entries:
+                previous_entry = previous_entries.get(name)
+                frozen_node = freeze(node, previous_entry[1] if previous_entry else None)
+                bucket.append(previous_entry if previous_entry and previous_entry[1] is frozen_node
+                              else (name, frozen_node))
+            if (previous_bucket is not None and len(previous_bucket) == len(bucket)
+                    and all(a is b for a, b in zip(bucket, previous_bucket))):
+                buckets.append(previous_bucket)
+            else:
+                buckets.append(tuple(bucket))
+
+        buckets = tuple(buckets)
+        if previous and all(a is b for a, b in zip(buckets, previous[0])):
+            buckets = previous[0]
+        state = (self.max_locations, self.hits, self.misses, self.clock)
+        if previous and previous[0] is buckets and previous[1:] == state:
+            return previous
+        return FrozenWorldGraph((buckets,) + state)
+
+    @classmethod
+    def thaw(cls, frozen: 'FrozenWorldGraph') -> 'WorldGraph':
+        """从快照恢复世界图，按last_used恢复访问顺序"""
+        buckets, max_locations, hits, misses, clock = frozen
+        nodes = [(name, thaw(node)) for bucket in buckets for name, node in bucket]
+        nodes.sort(key=lambda item: item[1].get("last_used", 0))
+        graph = cls(max_locations)
+        graph.nodes = OrderedDict(nodes)
+        graph.hits = hits
+        graph.misses = misses
+        graph.clock = clock
+        return graph
+
+
+class FrozenDict(tuple):
+    """快照中的不可变字典，按顺序保存(键, 值)"""
+
+
+class FrozenWorldGraph(tuple):
+    """快照中的不可变世界图"""
+
+
+def freeze(value: Any, previous: Any = None) -> Any:
+    """
+    把可变状态转换为不可变快照；与previous相同的部分直接复用previous。
+
+    字典按字段逐项共享；列表变化时整体复制为新的元组，但元素仍按引用保存
+    （故事历史条目追加后不再修改），背包和最多15条的故事历史每回合只多出
+    一个短元组。世界图按桶共享，见WorldGraph.freeze。
+    """
+    if isinstance(value, WorldGraph):
+        return value.freeze(previous if isinstance(previous, FrozenWorldGraph) else None)
+
+    if isinstance(value, list):
+        if (type(previous) is tuple and len(previous) == len(value)
+                and all(a is b for a, b in zip(value, previous))):
+            return previous
+        return tuple(value)
+
+    if isinstance(value, dict):
+        previous_items = dict(previous) if isinstance(previous, FrozenDict) else {}
+        items = FrozenDict((key, freeze(item, previous_items.get(key))) for key, item in value.items())
+        if (isinstance(previous, FrozenDict) and len(previous) == len(items)
+                and all(a[0] == b[0] and a[1] is b[1] for a, b in zip(items, previous))):
+            return previous
+        return items
+
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """把快照恢复为新的可变对象（写时复制：只有恢复时才复制）"""
+    if isinstance(value, FrozenWorldGraph):
+        return WorldGraph.thaw(value)
+    if isinstance(value, FrozenDict):
+        return {key: thaw(item) for key, item in value}
+    if type(value) is tuple:
+        return list(value)
+    return value
+
+
+class SnapshotHistory:
+    def __init__(self, max_snapshots: int = 100):
+        """
+        每回合的GameState快照，用于 /undo 和命名分支
+
+        Args:
+            max_snapshots: 最多保留的回合快照数量
+        """
+        self.snapshots = deque(maxlen=max_snapshots)
+        self.branches = {}
+
+    def capture(self, state: GameState) -> Tuple[type, FrozenDict]:
+        """生成快照(状态类型, 字段)，与最近一个快照共享未变化的部分"""
+        previous = self.snapshots[-1][1] if self.snapshots else None
+        return type(state), freeze(state.snapshot_fields(), previous)
+
+    def record(self, state: GameState):
+        """保存回合开始前的状态"""
+        self.snapshots.append(self.capture(state))
+
+    def undo(self, steps: int = 1) -> Optional[GameState]:
+        """撤销最近steps个回合，返回恢复后的状态；可撤销的回合不足时返回None"""
+        if steps < 1 or steps > len(self.snapshots):
+            return None
+        for _ in range(steps):
+            target = self.snapshots.pop()
+        return self.restore(target)
+
+    def save_branch(self, name: str, state: GameState):
+        """把当前状态和撤销历史保存为命名分支"""
+        self.branches[name] = (self.capture(state), tuple(self.snapshots))
+
+    def load_branch(self, name: str) -> Optional[GameState]:
+        """切换到命名分支，分支不存在时返回None"""
+        branch = self.branches.get(name)
+        if branch is None:
+            return None
+        snapshot, history = branch
+        self.snapshots = deque(history, maxlen=self.snapshots.maxlen)
+        return self.restore(snapshot)
+
+    @staticmethod
+    def restore(snapshot: Tuple[type, FrozenDict]) -> GameState:
+        """由快照创建新的GameState"""
+        state_class, fields = snapshot
+        return state_class.from_snapshot_fields(thaw(fields))
+
+
+class DiceEngine:
+    MODES = ('normal', 'advantage', 'disadvantage')
+    ATTRIBUTE_NAMES = {"strength": "力量", "agility": "敏捷", "intelligence": "智力"}
+    MAX_DICE = 100
+    MAX_SIDES = 1000
+    MAX_TERMS = 20
+    # 分布宽度（各骰 count*(sides-1) 之和）上限，纯Python卷积的耗时随宽度平方增长
+    MAX_SUPPORT_WIDTH = 2000
+
+    # 分布统一表示为 (最小值, 各点的组合数, 组合总数)，全部为整数，概率精确
+
+    @staticmethod
+    def attribute_modifier(score: int) -> int:
+        """属性值对应的检定调整值，10-11为0，每2点±1"""
+        return (score - 10) // 2
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def parse(expression: str) -> Tuple[Tuple[Tuple[int, int], ...], int]:
+        """解析骰子表达式，如 2d6+3、d20-1、1d8+1d4，返回((带符号的骰子数, 面数), ...)和常数"""
+        text = expression.strip()
+        if not text:
+            raise ValueError("骰子表达式为空")
+
+        dice, constant, position, width = [], 0, 0, 0
+        while position < len(text):
+            match = DICE_TERM_PATTERN.match(text, position)
+            if not match or match.end() == position or (position and not match.group(1)):
+                raise ValueError(f"无法解析骰子表达式: {expression}")
+            sign = -1 if match.group(1) == '-' else 1
+            if match.group(3):
+                count = int(match.group(2) or 1)
+                sides = int(match.group(3))
+                if not 1 <= count <= DiceEngine.MAX_DICE or not 1 <= sides <= DiceEngine.MAX_SIDES:
+                    raise ValueError(f"骰子数量或面数超出范围: {match.group().strip()}")
+                dice.append((sign * count, sides))
+                width += count * (sides - 1)
+                if len(dice) > DiceEngine.MAX_TERMS or width > DiceEngine.MAX_SUPPORT_WIDTH:
+                    raise ValueError(f"骰子表达式过大: {expression}")
+            else:
+                constant += sign * int(match.group(4))
+            position = match.end()
+        return tuple(dice), constant
+
+    @staticmethod
+    def convolve(a: Tuple[int, Tuple[int, ...]], b: Tuple[int, Tuple[int, ...]]) -> Tuple[int, Tuple[int, ...]]:
+        """两个独立分布之和的卷积"""
+        offset_a, counts_a = a
+        offset_b, counts_b = b
+        result = [0] * (len(counts_a) + len(counts_b) - 1)
+        for i, x in enumerate(counts_a):
+            if x:
+                for j, y in enumerate(counts_b):
+                    result[i + j] += x * y
+        return offset_a + offset_b, tuple(result)
+
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def dice_distribution(count: int, sides: int) -> Tuple[int, Tuple[int, ...]]:
+        """count个sides面骰之和的分布，按骰子数对半拆分递归卷积"""
+        if count == 1:
+            return 1, (1,) * sides
+        half = count // 2
+        return DiceEngine.convolve(DiceEngine.dice_distribution(half, sides),
+                                   DiceEngine.dice_distribution(count - half, sides))
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def distribution(expression: str, mode: str = 'normal') -> Tuple[int, Tuple[int, ...], int]:
+        """表达式的精确分布；优势/劣势为整个表达式投两次取高/取低"""
+        if mode not in DiceEngine.MODES:
+            raise ValueError(f"未知的检定模式: {mode}")
+
+        dice, constant = DiceEngine.parse(expression)
+        result = (constant, (1,))
+        for count, sides in dice:
+            offset, counts = DiceEngine.dice_distribution(abs(count), sides)
+            if count < 0:
+                offset, counts = -(offset + len(counts) - 1), counts[::-1]
+            result = DiceEngine.convolve(result, (offset, counts))
+
+        offset, counts = result
+        total = sum(counts)
+        if mode == 'normal':
+            return offset, counts, total
+
+        # 由累积分布推出两次取高/取低的分布
+        new_counts, below = [], 0
+        for count in counts:
+            at_or_below = below + count
+            if mode == 'advantage':
+                new_counts.append(at_or_below ** 2 - below ** 2)
+            else:
+                new_counts.append((total - below) ** 2 - (total - at_or_below) ** 2)
+            below = at_or_below
+        return offset, tuple(new_counts), total ** 2
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def success_table(expression: str, mode: str = 'normal') -> Tuple[int, Tuple[int, ...], int]:
+        """预计算的“结果≥目标值”组合数表（后缀和）"""
+        offset, counts, total = DiceEngine.distribution(expression, mode)
+        table, at_least = [], 0
+        for count in reversed(counts):
+            at_least += count
+            table.append(at_least)
+        return offset, tuple(reversed(table)), total
+
+    @staticmethod
+    def success_probability(difficulty: int, modifier: int = 0, expression: str = '1d20',
+                            mode: str = 'normal') -> Fraction:
+        """检定成功（结果+调整值≥难度）的精确概率，查表O(1)"""
+        offset, table, total = DiceEngine.success_table(expression, mode)
+        index = difficulty - modifier - offset
+        if index <= 0:
+            return Fraction(1)
+        if index >= len(table):
+            return Fraction(0)
+        return Fraction(table[index], total)
+
+    @staticmethod
+    def expected_value(expression: str, mode: str = 'normal') -> Fraction:
+        """表达式的期望值"""
+        offset, counts, total = DiceEngine.distribution(expression, mode)
+        return Fraction(sum((offset + i) * count for i, count in enumerate(counts)), total)
+
+    @staticmethod
+    def precompute():
+        """预热d20在各种检定模式下的成功率表"""
+        for mode in DiceEngine.MODES:
+            DiceEngine.success_table('1d20', mode)
+
+    @staticmethod
+    def roll(expression: str = '1d20', mode: str = 'normal') -> int:
+        """按表达式投骰，优势/劣势时投两次取高/取低"""
+        if mode not in DiceEngine.MODES:
+            raise ValueError(f"未知的检定模式: {mode}")
+
+        dice, constant = DiceEngine.parse(expression)
+
+        def roll_once():
+            total = constant
+            for count, sides in dice:
+                value = sum(random.randint(1, sides) for _ in range(abs(count)))
+                total += value if count > 0 else -value
+            return total
+
+        if mode == 'advantage':
+            return max(roll_once(), roll_once())
+        if mode == 'disadvantage':
+            return min(roll_once(), roll_once())
+        return roll_once()
+
+
+class SingleFlight:
+    def __init__(self):
+        """合并并发的相同请求：同一个键同时只执行一次，其余调用等待并共享结果"""
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: Any, fn):
+        """执行fn；若相同键的调用正在进行，则等待其结果"""
+        with self.lock:
+            flight = self.in_flight.get(key)
+            if flight is None:
+                flight = {"done": threading.Event(), "result": None, "error": None}
+                self.in_flight[key] = flight
+                leader = True
+                self.executed += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["result"]
+
+        try:
+            flight["result"] = fn()
+            return flight["result"]
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight["done"].set()
+
+    def stats(self) -> Dict[str, int]:
+        """实际执行与被合并（节省）的调用次数"""
+        with self.lock:
+            return {"executed": self.executed, "coalesced": self.coalesced}
 
 
 class DeepSeekInterface:
-    def __init__(self, api_key: str = None, base_url: str = "https://api.deepseek.com", model: str = "deepseek-chat"):
+    def __init__(self, api_key: str = None, base_url: str = "https://api.deepseek.com", model: str = "deepseek-chat",
+                 coalesce_temperatures: tuple = ()):
         """
         初始化DeepSeek API接口
 
@@ -57,35 +797,55 @@ class DeepSeekInterface:
             api_key: DeepSeek API密钥
             base_url: API基础URL
             model: 模型名称，默认使用deepseek-chat
+            coalesce_temperatures: 启用请求合并的温度值，这些温度下并发的相同请求只调用一次API
         """
         self.api_key = api_key
         self.base_url = base_url
         self.model = model
+        self.coalesce_temperatures = set(coalesce_temperatures)
+        self.single_flight = SingleFlight()
 
         if not api_key:
             raise ValueError("需要提供DeepSeek API密钥")
 
+        self.client = self.create_client()
+
+    def create_client(self):
+        """创建API客户端；没有openai库时返回None，改用requests直接调用"""
         # 设置OpenAI客户端使用DeepSeek的端点
         if OPENAI_AVAILABLE:
-            self.client = openai.OpenAI(
-                api_key=api_key,
-                base_url=base_url
+            return openai.OpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url
             )
         elif REQUESTS_AVAILABLE:
             # 如果没有openai库，使用requests直接调用
-            self.client = None
+            return None
         else:
             raise ImportError("需要安装 openai 或 requests 库: pip install openai 或 pip install requests")
 
-    def generate_response(self, messages: list) -> str:
+    def generate_response(self, messages: list, temperature: float = 0.8) -> str:
         """生成DeepSeek响应"""
+        if temperature not in self.coalesce_temperatures:
+            return self.request_completion(messages, temperature)
+
+        key = (self.model, temperature, json.dumps(messages, ensure_ascii=False, sort_keys=True))
+        return self.single_flight.do(key, lambda: self.request_completion(messages, temperature))
+
+    def coalescing_stats(self) -> Dict[str, int]:
+        """请求合并计数：上游调用次数和节省的调用次数"""
+        stats = self.single_flight.stats()
+        return {"upstream_calls": stats["executed"], "calls_saved": stats["coalesced"]}
+
+    def request_completion(self, messages: list, temperature: float) -> str:
+        """调用DeepSeek API"""
         try:
             if self.client:  # 使用openai库
                 response = self.client.chat.completions.create(
                     model=self.model,
                     messages=messages,
                     max_tokens=800,
-                    temperature=0.8,
+                    temperature=temperature,
                     top_p=0.95
                 )
                 return response.choices[0].message.content
@@ -100,7 +860,7 @@ class DeepSeekInterface:
                     "model": self.model,
                     "messages": messages,
                     "max_tokens": 800,
-                    "temperature": 0.8,
+                    "temperature": temperature,
                     "top_p": 0.95,
                     "stream": False
                 }
@@ -120,16 +880,471 @@ class DeepSeekInterface:
 
         except Exception as e:
             print(f"DeepSeek API调用错误: {e}")
-            return "抱歉，AI暂时无法响应，将使用基础逻辑处理你的行动。"
+            return FALLBACK_RESPONSE
+
+
+class WorldEventPool:
+    EFFECT_KEYS = ('health', 'mana', 'gold', 'strength', 'agility', 'intelligence')
+
+    def __init__(self, deepseek: DeepSeekInterface, capacity: int = 6, low_water: int = 2, max_keys: int = 64):
+        """
+        后台预生成的世界事件池，按(地点, 时间)分组，回合中取事件不需要等待网络
+
+        Args:
+            deepseek: 用于生成事件的DeepSeek接口
+            capacity: 每个(地点, 时间)最多缓存的事件数
+            low_water: 剩余事件少于该值时触发后台补充
+            max_keys: 最多缓存的(地点, 时间)组数，超出后淘汰最久未使用的一组
+        """
+        self.deepseek = deepseek
+        self.capacity = capacity
+        self.low_water = low_water
+        self.max_keys = max_keys
+        self.pools = OrderedDict()
+        self.pending = set()
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.generated = 0
+        self.served = 0
+        self.misses = 0
+
+    def start(self):
+        """启动后台补充线程（首次需要补充时自动调用）"""
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self.refill_loop, daemon=True)
+            self.worker.start()
+
+    def stop(self):
+        """停止后台补充线程"""
+        if self.worker is not None:
+            self.requests.put(None)
+            self.worker.join(timeout=1)
+            self.worker = None
+
+    def draw(self, location: str, time_of_day: str) -> Optional[Dict[str, Any]]:
+        """取出一个匹配地点和时间的事件，池为空时返回None"""
+        key = (location, time_of_day)
+        with self.lock:
+            events = self.pools.get(key)
+            if events:
+                self.pools.move_to_end(key)
+                self.served += 1
+                return events.popleft()
+            self.misses += 1
+        return None
+
+    def prefetch(self, location: str, time_of_day: str, weather: str):
+        """事件不足时把(地点, 时间)加入后台补充队列"""
+        key = (location, time_of_day)
+        with self.lock:
+            events = self.pools.get(key)
+            if (events and len(events) >= self.low_water) or key in self.pending:
+                return
+            self.pending.add(key)
+        self.start()
+        self.requests.put((location, time_of_day, weather))
+
+    def refill_loop(self):
+        """后台线程：逐个处理补充请求"""
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            location, time_of_day, weather = request
+            try:
+                events = self.generate_events(location, time_of_day, weather)
+            except Exception as e:
+                print(f"世界事件生成错误: {e}")
+                events = []
+            self.add_events(location, time_of_day, events)
+
+    def add_events(self, location: str, time_of_day: str, events: list):
+        """将事件加入对应的池，超出容量的部分丢弃"""
+        key = (location, time_of_day)
+        with self.lock:
+            self.pending.discard(key)
+            if not events:
+                return
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = deque(maxlen=self.capacity)
+            pool.extend(events)
+            self.generated += len(events)
+            self.pools.move_to_end(key)
+            while len(self.pools) > self.max_keys:
+                self.pools.popitem(last=False)
+
+    def generate_events(self, location: str, time_of_day: str, weather: str) -> list:
+        """请求DeepSeek生成一批世界事件"""
+        prompt = f"""为奇幻文字冒险游戏生成{self.capacity}个简短的随机世界事件。
+
+地点: {location}
+时间: {time_of_day}
+天气: {weather}
+
+每个事件可以附带轻微的属性影响(-10到10)，也可以带来天气变化(可选，取值: {', '.join(WEATHER_OPTIONS)})。
+请严格按照以下JSON数组格式回复：
+[
+    {{
+        "description": "事件描述",
+        "weather": "新天气(可选)",
+        "effects": {{"health": 0, "mana": 0, "gold": 0, "strength": 0, "agility": 0, "intelligence": 0}}
+    }}
+]"""
+        response = self.deepseek.generate_response([{"role": "user", "content": prompt}])
+        json_match = re.search(r'\[.*\]', response, re.DOTALL)
+        if not json_match:
+            return []
+        try:
+            raw_events = json.loads(json_match.group())
+        except json.JSONDecodeError:
+            return []
+        return [event for event in map(self.sanitize_event, raw_events) if event]
+
+    def sanitize_event(self, raw: Any) -> Optional[Dict[str, Any]]:
+        """校验模型生成的事件，只保留已知效果并限制数值范围"""
+        if not isinstance(raw, dict) or not isinstance(raw.get('description'), str):
+            return None
+        effects = {}
+        for key, value in (raw.get('effects') or {}).items():
+            if key in self.EFFECT_KEYS and isinstance(value, (int, float)) and value:
+                effects[key] = max(-10, min(10, int(value)))
+        event = {'description': raw['description'], 'effects': effects}
+        if raw.get('weather') in WEATHER_OPTIONS:
+            event['weather'] = raw['weather']
+        return event
+
+
+def estimate_tokens(messages: list) -> int:
+    """估算消息列表的token数"""
+    return int(sum(len(message['content']) for message in messages) * TOKENS_PER_CHAR)
+
+
+class CampaignAnalytics:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS turns (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            turn INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            action TEXT NOT NULL,
+            location TEXT,
+            model_called INTEGER NOT NULL,
+            needs_roll INTEGER NOT NULL,
+            dice_roll INTEGER,
+            difficulty INTEGER,
+            success INTEGER,
+            effects TEXT,
+            latency_ms REAL NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            fallback INTEGER NOT NULL,
+            parse_failed INTEGER NOT NULL,
+            died INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_turns_session ON turns(session_id, turn);
+        CREATE INDEX IF NOT EXISTS idx_turns_action ON turns(action);
+        CREATE INDEX IF NOT EXISTS idx_turns_flags ON turns(fallback, parse_failed, died);
+        CREATE INDEX IF NOT EXISTS idx_turns_difficulty ON turns(difficulty);
+    """
+
+    COLUMNS = ('session_id', 'turn', 'created_at', 'action', 'location', 'model_called', 'needs_roll',
+               'dice_roll', 'difficulty', 'success', 'effects', 'latency_ms', 'prompt_tokens',
+               'completion_tokens', 'fallback', 'parse_failed', 'died')
+
+    # 常用汇总报表
+    QUERIES = {
+        "summary": """
+            SELECT COUNT(*) AS turns,
+                   COUNT(DISTINCT session_id) AS sessions,
+                   AVG(latency_ms) AS avg_latency_ms,
+                   MAX(latency_ms) AS max_latency_ms,
+                   AVG(fallback) AS fallback_rate,
+                   AVG(parse_failed) AS parse_failure_rate,
+                   SUM(died) AS deaths,
+                   SUM(model_called) AS model_calls,
+                   SUM(prompt_tokens + completion_tokens) AS tokens
+            FROM turns
+        """,
+        "fallback_actions": """
+            SELECT action, COUNT(*) AS turns, SUM(fallback) AS fallbacks, AVG(fallback) AS fallback_rate
+            FROM turns GROUP BY action HAVING fallbacks > 0
+            ORDER BY fallbacks DESC LIMIT :limit
+        """,
+        "parse_failure_actions": """
+            SELECT action, COUNT(*) AS turns, SUM(parse_failed) AS parse_failures,
+                   AVG(parse_failed) AS parse_failure_rate
+            FROM turns GROUP BY action HAVING parse_failures > 0
+            ORDER BY parse_failures DESC LIMIT :limit
+        """,
+        "death_actions": """
+            SELECT action, location, COUNT(*) AS deaths
+            FROM turns WHERE died = 1
+            GROUP BY action, location ORDER BY deaths DESC LIMIT :limit
+        """,
+        "success_by_difficulty": """
+            SELECT difficulty, COUNT(*) AS checks, AVG(success) AS success_rate, AVG(dice_roll) AS avg_roll
+            FROM turns WHERE needs_roll = 1 AND difficulty IS NOT NULL
+            GROUP BY difficulty ORDER BY difficulty
+        """,
+        "slowest_actions": """
+            SELECT action, COUNT(*) AS turns, AVG(latency_ms) AS avg_latency_ms,
+                   AVG(prompt_tokens + completion_tokens) AS avg_tokens
+            FROM turns WHERE model_called = 1
+            GROUP BY action ORDER BY avg_latency_ms DESC LIMIT :limit
+        """,
+    }
+
+    def __init__(self, path: str, batch_size: int = 200, flush_interval: float = 1.0):
+        """
+        按回合记录战役数据到SQLite，写入在后台线程中批量提交，不阻塞回合处理
+
+        Args:
+            path: SQLite数据库文件路径
+            batch_size: 每次提交的最大记录数
+            flush_interval: 最长等待多少秒后提交不满一批的记录
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records = queue.Queue()
+        self.written = 0
+        self.dropped = 0
+
+        # 先在当前线程建表，保证查询可以立即进行
+        connection = self.connect()
+        connection.executescript(self.SCHEMA)
+        connection.close()
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def connect(self) -> sqlite3.Connection:
+        """打开WAL模式的连接"""
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def record_turn(self, record: Dict[str, Any]):
+        """提交一条回合记录（只入队，立即返回）"""
+        record = dict(record, effects=json.dumps(record.get("effects") or {}, ensure_ascii=False))
+        self.records.put(tuple(record.get(column) for column in self.COLUMNS))
+
+    def write_loop(self):
+        """后台线程：攒批后在一个事务中写入"""
+        connection = self.connect()
+        sql = f"INSERT INTO turns ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})"
+        running = True
+        while running:
+            try:
+                first = self.records.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = []
+            item = first
+            while True:
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.records.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    with connection:
+                        connection.executemany(sql, batch)
+                    self.written += len(batch)
+                except sqlite3.Error as e:
+                    print(f"战役数据写入错误: {e}")
+                    self.dropped += len(batch)
+        connection.close()
+
+    def close(self):
+        """写入剩余记录并停止后台线程"""
+        if self.writer.is_alive():
+            self.records.put(None)
+            self.writer.join()
+
+    def query(self, name: str, limit: int = 10) -> list:
+        """运行内置报表，返回字典列表"""
+        return self.run_query(self.path, name, limit)
+
+    @classmethod
+    def run_query(cls, path: str, name: str, limit: int = 10) -> list:
+        """以只读方式打开已有数据库运行内置报表，不会创建文件或启动写入线程"""
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"战役数据库不存在: {path}")
+        connection = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+        connection.row_factory = sqlite3.Row
+        try:
+            rows = connection.execute(cls.QUERIES[name], {"limit": limit}).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            connection.close()
+
+
+class SpeculativeGenerator:
+    RESPONSE_TOKENS = 800  # 与generate_response的max_tokens一致
+
+    def __init__(self, deepseek: DeepSeekInterface, top_k: int = 2, token_budget: int = 50000):
+        """
+        在玩家阅读结果时，后台为最可能的下一步行动预先请求DM响应
+
+        推测只产生原始响应文本，只有玩家实际输入的行动与预测一致、且提示完全相同时
+        才会被解析和应用，因此被丢弃的预测不会修改GameState。
+
+        Args:
+            deepseek: DeepSeek接口
+            top_k: 每回合预测的行动数
+            token_budget: 推测请求累计可消耗的token上限（按提示长度和最大响应长度估算）
+        """
+        self.deepseek = deepseek
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.executor = ThreadPoolExecutor(max_workers=max(1, top_k))
+        self.pending = {}
+        self.tokens_spent = 0
+        self.launched = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    @staticmethod
+    def normalize(action: str) -> str:
+        """忽略首尾空白和结尾标点"""
+        return action.strip().rstrip('。.!！?？').strip()
+
+    def predict_actions(self, game_state: GameState) -> list:
+        """预测最可能的下一步行动"""
+        candidates = []
+        if game_state.enemies:
+            candidates.append(f"攻击{game_state.enemies[0]}")
+        candidates.extend(["查看周围", "搜索"])
+        if game_state.last_action:
+            candidates.append(self.normalize(game_state.last_action))
+
+        predictions = []
+        for action in candidates:
+            if action not in predictions:
+                predictions.append(action)
+        return predictions[:self.top_k]
+
+    def speculate(self, game: 'IntelligentTextAdventureGame'):
+        """丢弃旧的预测，并为当前状态发起新的预测请求"""
+        self.discard()
+        for action in self.predict_actions(game.game_state):
+            # 提示在主线程中生成，后台线程只负责网络请求
+            messages = game.create_dm_prompt(action)
+            cost = estimate_tokens(messages) + self.RESPONSE_TOKENS
+            if self.tokens_spent + cost > self.token_budget:
+                self.skipped += 1
+                break
+            self.tokens_spent += cost
+            self.launched += 1
+            self.pending[action] = (messages, self.executor.submit(self.deepseek.generate_response, messages), cost)
+
+    def take(self, action: str, build_messages) -> Optional[str]:
+        """
+        取出与玩家行动匹配的预测响应，其余预测全部丢弃
+
+        Args:
+            action: 玩家输入的行动
+            build_messages: 按当前状态为行动生成提示的函数，用于确认预测时的状态未变化
+
+        Returns:
+            预测的响应文本；没有匹配或状态已变化时返回None
+        """
+        if not self.pending:
+            return None
+
+        predicted = self.normalize(action)
+        entry = self.pending.pop(predicted, None)
+        self.discard()
+        if entry is None or entry[0] != build_messages(predicted):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry[1].result()
+
+    def discard(self):
+        """丢弃所有未使用的预测，尚未开始的请求直接取消并退还预算"""
+        for _, future, cost in self.pending.values():
+            if future.cancel():
+                self.tokens_spent -= cost
+        self.pending.clear()
+
+    def close(self):
+        """停止后台线程"""
+        self.discard()
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, int]:
+        """推测命中情况与token消耗"""
+        return {
+            "launched": self.launched,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped_over_budget": self.skipped,
+            "tokens_spent": self.tokens_spent,
+            "token_budget": self.token_budget,
+        }
 
 
 class IntelligentTextAdventureGame:
-    def __init__(self, api_key: str = None):
-        self.game_state = GameState()
+    def __init__(self, api_key: str = None, deepseek: DeepSeekInterface = None, speculative: bool = False,
+                 analytics: CampaignAnalytics = None, stat_store: SessionStatStore = None,
+                 event_pool: 'WorldEventPool' = None, speculative_top_k: int = 2,
+                 speculative_token_budget: int = 50000, analytics_db: str = None,
+                 batch_stat_effects: bool = False):
+        """
+        初始化游戏
+
+        Args:
+            api_key: DeepSeek API密钥
+            deepseek: 已创建的DeepSeek接口，多个会话共享同一接口时才能合并相同请求
+            speculative: 是否在玩家阅读结果时预先请求可能的下一步行动
+            analytics: 战役数据记录器，可在多个会话之间共享，由调用方负责关闭
+            stat_store: 共享的数值属性列存储，托管大量会话时用于批量更新
+            event_pool: 共享的世界事件池，默认每个会话创建自己的事件池
+            speculative_top_k: 预测模式每回合预测的行动数
+            speculative_token_budget: 预测模式累计可消耗的token上限
+            analytics_db: 未提供analytics时，由本会话创建并在退出时关闭的战役数据库路径
+            batch_stat_effects: 使用stat_store时，数值效果只暂存，由主机统一批量结算
+        """
+        self.stat_store = stat_store
+        self.batch_stat_effects = batch_stat_effects and stat_store is not None
+        self.game_state = self.new_game_state()
         self.deepseek = None
+        self.event_pool = None
+        self.owns_event_pool = False
+        self.speculator = None
+        self.speculative_top_k = speculative_top_k
+        self.speculative_token_budget = speculative_token_budget
+        self.analytics = analytics
+        self.owns_analytics = False
+        if analytics is None and analytics_db:
+            self.analytics = CampaignAnalytics(analytics_db)
+            self.owns_analytics = True
+        self.session_id = uuid.uuid4().hex
+        self.turn_record = None
+        self.snapshots = SnapshotHistory()
+        DiceEngine.precompute()
 
         # 尝试初始化DeepSeek
-        if api_key:
+        if deepseek:
+            self.deepseek = deepseek
+        elif api_key:
             try:
                 self.deepseek = DeepSeekInterface(api_key)
                 print("✅ 成功连接到 DeepSeek V3")
@@ -139,6 +1354,23 @@ class IntelligentTextAdventureGame:
         else:
             print("⚠️ 未提供API密钥，将使用内置逻辑")
 
+        if event_pool:
+            self.event_pool = event_pool
+        elif self.deepseek:
+            self.event_pool = WorldEventPool(self.deepseek)
+            self.owns_event_pool = True
+
+        if speculative and self.deepseek:
+            self.speculator = SpeculativeGenerator(self.deepseek, self.speculative_top_k,
+                                                   self.speculative_token_budget)
+
+    def new_game_state(self) -> GameState:
+        """创建新的游戏状态；使用列存储时复用当前会话的行"""
+        if not self.stat_store:
+            return GameState()
+        current = getattr(self, 'game_state', None)
+        return PooledGameState(self.stat_store, current.slot if current else None)
+
     def print_colored(self, text, color='white'):
         """打印彩色文本"""
         colors = {
@@ -198,6 +1430,22 @@ class IntelligentTextAdventureGame:
         """投20面骰子"""
         return random.randint(1, 20)
 
+    def get_attribute_modifier(self, attribute: Optional[str]) -> int:
+        """检定所用属性的调整值，未指定属性时为0"""
+        if attribute not in DiceEngine.ATTRIBUTE_NAMES:
+            return 0
+        return DiceEngine.attribute_modifier(getattr(self.game_state, attribute))
+
+    def format_check_odds(self) -> str:
+        """各属性在常见难度下的d20检定成功率"""
+        lines = []
+        for attr, attr_name in DiceEngine.ATTRIBUTE_NAMES.items():
+            modifier = self.get_attribute_modifier(attr)
+            odds = ", ".join(f"DC{dc} {float(DiceEngine.success_probability(dc, modifier)):.0%}"
+                             for dc in (10, 13, 16, 19))
+            lines.append(f"  {attr_name}({modifier:+d}): {odds}")
+        return "\n".join(lines)
+
     def create_dm_prompt(self, player_action: str) -> list:
         """创建给DeepSeek的DM提示"""
         system_prompt = f"""你是一个专业的地下城主(DM)，负责运行一个文字冒险游戏。你的任务是：
@@ -213,15 +1461,19 @@ class IntelligentTextAdventureGame:
 - 生命值: {self.game_state.health}/{self.game_state.max_health}
 - 法力值: {self.game_state.mana}/{self.game_state.max_mana}
 - 力量: {self.game_state.strength}, 敏捷: {self.game_state.agility}, 智力: {self.game_state.intelligence}
+- 检定成功率(d20+属性调整值):
+{self.format_check_odds()}
 - 金币: {self.game_state.gold}
 - 当前位置: {self.game_state.location}
 - 环境描述: {self.game_state.environment}
+- 已知出口: {', '.join(self.game_state.world_graph.exits(self.game_state.location)) or '无'}
 - 背包物品: {', '.join(self.game_state.inventory) if self.game_state.inventory else '无'}
 - 当前敌人: {', '.join(self.game_state.enemies) if self.game_state.enemies else '无'}
 - 天气: {self.game_state.world_state['weather']}, 时间: {self.game_state.world_state['time_of_day']}
 
 游戏规则：
 - 骰子检定：1-5(大失败), 6-10(失败), 11-15(成功), 16-20(大成功)
+- 检定结果 = d20 + 所用属性的调整值，优势取两次中的高值，劣势取低值
 - 简单行动难度10-12，一般行动难度13-15，困难行动难度16-18，极难行动难度19-20
 - 角色死亡时生命值降到0，但可以复活继续冒险
 
@@ -229,6 +1481,8 @@ class IntelligentTextAdventureGame:
 {{
     "needs_roll": true/false,
     "difficulty": 数字(1-20, 仅当needs_roll为true时),
+    "attribute": "strength/agility/intelligence(检定所用属性，可选)",
+    "roll_mode": "normal/advantage/disadvantage(可选，默认normal)",
     "description": "对玩家行动的生动描述和情境设定",
     "success_outcome": "成功时的结果描述(仅当needs_roll为true时)",
     "failure_outcome": "失败时的结果描述(仅当needs_roll为true时)", 
@@ -318,6 +1572,11 @@ class IntelligentTextAdventureGame:
 
         return messages
 
+    def note_turn(self, **fields):
+        """记录当前回合的统计字段（不在回合处理中时忽略）"""
+        if self.turn_record is not None:
+            self.turn_record.update(fields)
+
     def parse_deepseek_response(self, response: str) -> Dict[str, Any]:
         """解析DeepSeek的JSON响应"""
         try:
@@ -343,6 +1602,7 @@ class IntelligentTextAdventureGame:
                 return parsed
             else:
                 # 如果没有找到JSON，返回默认结构
+                self.note_turn(parse_failed=response != FALLBACK_RESPONSE)
                 return {
                     "needs_roll": False,
                     "direct_outcome": response,
@@ -350,6 +1610,7 @@ class IntelligentTextAdventureGame:
                 }
         except json.JSONDecodeError as e:
             print(f"JSON解析错误: {e}")
+            self.note_turn(parse_failed=True)
             # JSON解析失败，返回默认结构
             return {
                 "needs_roll": False,
@@ -363,39 +1624,34 @@ class IntelligentTextAdventureGame:
             return
 
         # 属性变化
+        batched = self.queue_stat_effects(effects)
         for attr in ['health', 'mana', 'strength', 'agility', 'intelligence', 'gold']:
-            if attr in effects and effects[attr] != 0:
-                current_value = getattr(self.game_state, attr)
-                change = effects[attr]
-                new_value = current_value + change
+            # 模型可能给出小数，统一截断为整数
+            change = int(effects.get(attr) or 0)
+            if change != 0 and not batched:
+                # 限制规则在add_stat中统一处理
+                new_value = self.game_state.add_stat(attr, change)
 
-                # 应用限制
                 if attr == 'health':
-                    new_value = max(0, min(self.game_state.max_health, new_value))
                     if change != 0:
                         sign = "+" if change > 0 else ""
                         self.print_system_message(
                             f"💗 生命值变化: {sign}{change} (当前: {new_value}/{self.game_state.max_health})")
                 elif attr == 'mana':
-                    new_value = max(0, min(self.game_state.max_mana, new_value))
                     if change != 0:
                         sign = "+" if change > 0 else ""
                         self.print_system_message(
                             f"✨ 法力值变化: {sign}{change} (当前: {new_value}/{self.game_state.max_mana})")
                 elif attr in ['strength', 'agility', 'intelligence']:
-                    new_value = max(1, new_value)
                     if change != 0:
                         sign = "+" if change > 0 else ""
                         attr_name = {"strength": "力量", "agility": "敏捷", "intelligence": "智力"}[attr]
                         self.print_system_message(f"📈 {attr_name}变化: {sign}{change} (当前: {new_value})")
                 elif attr == 'gold':
-                    new_value = max(0, new_value)
                     if change != 0:
                         sign = "+" if change > 0 else ""
                         self.print_system_message(f"💰 金币变化: {sign}{change} (当前: {new_value})")
 
-                setattr(self.game_state, attr, new_value)
-
         # 物品变化
         if 'add_items' in effects:
             for item in effects['add_items']:
@@ -408,14 +1664,17 @@ class IntelligentTextAdventureGame:
                     self.game_state.inventory.remove(item)
                     self.print_system_message(f"🗑️ 失去物品: {item}")
 
-        # 位置变化
-        if 'location_change' in effects:
-            old_location = self.game_state.location
-            self.game_state.location = effects['location_change']
-            self.print_system_message(f"🗺️ 位置变化: {old_location} → {self.game_state.location}")
+        # 位置变化（已访问过的地点从世界图缓存恢复，忽略模型重新生成的描述）
+        cached_location = False
+        if effects.get('location_change') and effects['location_change'] != self.game_state.location:
+            cached_location = self.enter_location(effects['location_change'])
 
-        if 'environment_change' in effects:
-            self.game_state.environment = effects['environment_change']
+        # 模型常对可选字段返回空字符串或null，只有非空描述才算作地点的描述
+        described = None
+        environment = effects.get('environment_change')
+        if isinstance(environment, str) and environment.strip() and not cached_location:
+            self.game_state.environment = environment
+            described = True
 
         # 敌人变化
         if 'add_enemies' in effects:
@@ -430,8 +1689,83 @@ class IntelligentTextAdventureGame:
                     self.game_state.enemies.remove(enemy)
                     self.print_system_message(f"✅ 敌人被击败: {enemy}")
 
+        self.remember_location(described=described)
+
+    def queue_stat_effects(self, effects: Dict[str, Any]) -> bool:
+        """批量结算模式下把数值效果交给stat_store暂存，返回是否已暂存"""
+        if not self.batch_stat_effects:
+            return False
+        changes = {}
+        for attr in SessionStatStore.EFFECT_STATS:
+            change = int(effects.get(attr) or 0)
+            if change != 0:
+                changes[attr] = change
+        if changes:
+            self.stat_store.queue_effects(self.game_state.slot, changes)
+            self.print_system_message(f"📊 属性变化将在结算时生效: {changes}")
+        return True
+
+    def remember_location(self, visit: bool = False, described: bool = None):
+        """把当前地点的状态写入世界图"""
+        self.game_state.world_graph.record(self.game_state.location, self.game_state.environment,
+                                           self.game_state.enemies, self.game_state.npcs, visit=visit,
+                                           described=described)
+
+    def enter_location(self, new_location: str) -> bool:
+        """移动到新地点，返回是否命中世界图缓存"""
+        graph = self.game_state.world_graph
+        old_location = self.game_state.location
+        self.remember_location()
+
+        self.game_state.location = new_location
+        cached = graph.get(new_location)
+        known = graph.nodes.get(new_location)
+        if cached:
+            self.game_state.environment = cached['environment']
+        if known:
+            self.game_state.enemies = list(known['enemies'])
+            self.game_state.npcs = list(known['npcs'])
+        else:
+            # 敌人和NPC属于地点，离开后留在原地
+            self.game_state.enemies = []
+            self.game_state.npcs = []
+
+        self.remember_location(visit=True)
+        graph.connect(old_location, new_location)
+        self.print_system_message(f"🗺️ 位置变化: {old_location} → {new_location}")
+        return cached is not None
+
+    def try_move_action(self, action: str) -> bool:
+        """纯移动行动：目标是当前地点的已知出口时直接从缓存处理，无需调用模型"""
+        match = MOVE_ACTION_PATTERN.match(action.strip())
+        if not match:
+            return False
+
+        target = match.group('target').strip()
+        graph = self.game_state.world_graph
+        if target not in graph.exits(self.game_state.location) or not graph.nodes.get(target, {}).get('described'):
+            return False
+
+        self.enter_location(target)
+        outcome = f"你沿着熟悉的道路来到了{target}。{self.game_state.environment}"
+        self.print_dm_message(outcome)
+        if self.game_state.enemies:
+            self.print_system_message(f"⚔️ 这里仍有敌人: {', '.join(self.game_state.enemies)}")
+
+        self.add_story_entry({"action": action, "response": outcome})
+        return True
+
+    def add_story_entry(self, story_entry: Dict[str, str]):
+        """添加到故事历史，并保持历史长度在合理范围内"""
+        self.game_state.story_history.append(story_entry)
+        if len(self.game_state.story_history) > 15:
+            self.game_state.story_history = self.game_state.story_history[-15:]
+
     def process_action_with_deepseek(self, action: str):
         """使用DeepSeek处理玩家行动"""
+        if self.try_move_action(action):
+            return
+
         if not self.deepseek:
             return self.fallback_process_action(action)
 
@@ -439,8 +1773,15 @@ class IntelligentTextAdventureGame:
             # 生成DeepSeek提示
             messages = self.create_dm_prompt(action)
 
-            # 获取DeepSeek响应
-            deepseek_response = self.deepseek.generate_response(messages)
+            # 获取DeepSeek响应（优先使用命中的预测）
+            deepseek_response = None
+            if self.speculator:
+                deepseek_response = self.speculator.take(action, self.create_dm_prompt)
+            if deepseek_response is None:
+                deepseek_response = self.deepseek.generate_response(messages)
+            self.note_turn(model_called=True, prompt_tokens=estimate_tokens(messages),
+                           completion_tokens=int(len(deepseek_response) * TOKENS_PER_CHAR),
+                           fallback=deepseek_response == FALLBACK_RESPONSE)
 
             # 解析响应
             parsed_response = self.parse_deepseek_response(deepseek_response)
@@ -448,22 +1789,37 @@ class IntelligentTextAdventureGame:
             # 处理响应
             if parsed_response.get('needs_roll'):
                 # 需要骰子检定
-                roll = self.roll_d20()
-                difficulty = parsed_response.get('difficulty', 15)
-                success = roll >= difficulty
+                try:
+                    difficulty = int(parsed_response.get('difficulty', 15))
+                except (TypeError, ValueError):
+                    difficulty = 15
+                attribute = parsed_response.get('attribute')
+                mode = parsed_response.get('roll_mode', 'normal')
+                if mode not in DiceEngine.MODES:
+                    mode = 'normal'
+                modifier = self.get_attribute_modifier(attribute)
+                chance = DiceEngine.success_probability(difficulty, modifier, mode=mode)
+
+                # 大成功/大失败看骰面，成败看骰面+调整值
+                roll = DiceEngine.roll('1d20', mode)
+                success = roll + modifier >= difficulty
 
                 self.print_dm_message(parsed_response.get('description', ''))
 
                 # 显示骰子结果
+                roll_text = f"{roll}{modifier:+d}={roll + modifier}" if modifier else f"{roll}"
+                check_text = f"(需要: {difficulty}, 成功率: {float(chance):.0%})"
+                if mode != 'normal':
+                    check_text += " [优势]" if mode == 'advantage' else " [劣势]"
                 if roll <= 5:
-                    result_text = f"🎲 大失败! 骰子结果: {roll} (需要: {difficulty})"
+                    result_text = f"🎲 大失败! 骰子结果: {roll_text} {check_text}"
                     self.print_colored(result_text, 'red')
                 elif roll >= 16:
-                    result_text = f"🎲 大成功! 骰子结果: {roll} (需要: {difficulty})"
+                    result_text = f"🎲 大成功! 骰子结果: {roll_text} {check_text}"
                     self.print_colored(result_text, 'green')
                 else:
                     color = 'green' if success else 'red'
-                    result_text = f"🎲 骰子结果: {roll} (需要: {difficulty}) - {'成功' if success else '失败'}"
+                    result_text = f"🎲 骰子结果: {roll_text} {check_text} - {'成功' if success else '失败'}"
                     self.print_colored(result_text, color)
 
                 print()
@@ -493,11 +1849,13 @@ class IntelligentTextAdventureGame:
                             effects[key] = int(value * 1.5)  # 大成功时效果增强
 
                 self.apply_effects(effects)
+                self.note_turn(needs_roll=True, dice_roll=roll, difficulty=difficulty, success=success,
+                               effects=effects)
 
                 # 记录故事
                 story_entry = {
                     "action": action,
-                    "response": f"{parsed_response.get('description', '')} [骰子: {roll}/{difficulty}] {story_outcome}"
+                    "response": f"{parsed_response.get('description', '')} [骰子: {roll_text}/{difficulty}] {story_outcome}"
                 }
 
             else:
@@ -506,6 +1864,7 @@ class IntelligentTextAdventureGame:
                 self.print_dm_message(outcome)
 
                 self.apply_effects(parsed_response.get('effects', {}))
+                self.note_turn(effects=parsed_response.get('effects', {}))
 
                 # 记录故事
                 story_entry = {
@@ -514,11 +1873,7 @@ class IntelligentTextAdventureGame:
                 }
 
             # 添加到故事历史
-            self.game_state.story_history.append(story_entry)
-
-            # 保持历史长度在合理范围内
-            if len(self.game_state.story_history) > 15:
-                self.game_state.story_history = self.game_state.story_history[-15:]
+            self.add_story_entry(story_entry)
 
         except Exception as e:
             print(f"DeepSeek处理错误: {e}")
@@ -526,26 +1881,30 @@ class IntelligentTextAdventureGame:
 
     def fallback_process_action(self, action: str):
         """后备处理方案（使用内置逻辑）"""
+        self.note_turn(fallback=True)
         action_lower = action.lower()
 
         # 简单的关键词匹配和响应
         if any(word in action_lower for word in ['攻击', '打', '杀', '战斗']):
             roll = self.roll_d20()
+            self.note_turn(needs_roll=True, dice_roll=roll, difficulty=12, success=roll >= 12)
             self.print_dm_message("你发起了攻击！")
             self.print_colored(f"🎲 骰子结果: {roll} (需要: 12)", 'cyan')
 
             if roll >= 12:
                 self.print_dm_message("你的攻击成功命中了目标！")
-                self.game_state.gold += 15
+                self.game_state.add_stat('gold', 15)
                 if self.game_state.enemies:
                     enemy = self.game_state.enemies.pop(0)
                     self.print_system_message(f"✅ 击败了 {enemy}")
+                    self.remember_location()
             else:
                 self.print_dm_message("你的攻击失败了，还受到了反击。")
-                self.game_state.health = max(0, self.game_state.health - 10)
+                self.game_state.add_stat('health', -10)
 
         elif any(word in action_lower for word in ['搜索', '寻找', '查看']):
             roll = self.roll_d20()
+            self.note_turn(needs_roll=True, dice_roll=roll, difficulty=10, success=roll >= 10)
             self.print_dm_message("你仔细搜索周围...")
             self.print_colored(f"🎲 骰子结果: {roll} (需要: 10)", 'cyan')
 
@@ -560,7 +1919,7 @@ class IntelligentTextAdventureGame:
         elif '治疗药水' in action_lower:
             if '治疗药水' in self.game_state.inventory:
                 self.print_dm_message("你喝下了治疗药水，感到身体在恢复。")
-                self.game_state.health = min(self.game_state.max_health, self.game_state.health + 30)
+                self.game_state.add_stat('health', 30)
                 self.game_state.inventory.remove('治疗药水')
                 self.print_system_message("💗 生命值恢复 +30")
             else:
@@ -648,8 +2007,15 @@ class IntelligentTextAdventureGame:
 - 输入任何你想做的事情，AI会理解并响应
 - /status - 查看角色状态
 - /inventory - 查看背包  
-- /roll - 手动投骰子
+- /roll [表达式] [adv/dis] [strength/agility/intelligence] - 手动投骰子，如 /roll 2d6+3
+- /odds - 查看各属性的检定成功率
 - /story - 查看最近的冒险历史
+- /map - 查看已探索的地点
+- /undo [N] - 撤销最近N个回合(默认1)
+- /save 名称 - 保存当前进度为命名分支
+- /load 名称 - 切换到命名分支
+- /branches - 查看已保存的分支
+- /speculate [on [token预算]/off] - 开关预测模式，或查看预测命中情况
 - /help - 显示帮助
 - /quit - 退出游戏
 
@@ -678,6 +2044,39 @@ class IntelligentTextAdventureGame:
         """
         self.print_colored(help_text, 'cyan')
 
+    def roll_expression(self, args: list):
+        """处理 /roll 表达式，显示结果和精确概率"""
+        expression, mode, attribute = '1d20', 'normal', None
+        for arg in args:
+            arg = arg.lower()
+            if arg in ('adv', 'advantage', '优势'):
+                mode = 'advantage'
+            elif arg in ('dis', 'disadvantage', '劣势'):
+                mode = 'disadvantage'
+            elif arg in DiceEngine.ATTRIBUTE_NAMES:
+                attribute = arg
+            else:
+                expression = arg
+
+        try:
+            roll = DiceEngine.roll(expression, mode)
+            expected = DiceEngine.expected_value(expression, mode)
+        except ValueError as e:
+            self.print_system_message(f"❌ {e}")
+            return
+
+        modifier = self.get_attribute_modifier(attribute)
+        text = f"🎲 {expression}"
+        if mode != 'normal':
+            text += " (优势)" if mode == 'advantage' else " (劣势)"
+        if attribute:
+            text += f" {DiceEngine.ATTRIBUTE_NAMES[attribute]}{modifier:+d}"
+        text += f": 你投出了 {roll + modifier} (期望 {float(expected) + modifier:.2f})"
+
+        odds = ", ".join(f"≥{target} {float(DiceEngine.success_probability(target, modifier, expression, mode)):.1%}"
+                         for target in (10, 13, 16, 19))
+        self.print_system_message(f"{text}\n   成功率: {odds}")
+
     def show_story_history(self):
         """显示最近的冒险历史"""
         if not self.game_state.story_history:
@@ -695,37 +2094,184 @@ class IntelligentTextAdventureGame:
 
         print("=" * 60)
 
+    def undo_turns(self, args: list):
+        """处理 /undo [N]"""
+        try:
+            steps = int(args[0]) if args else 1
+        except ValueError:
+            self.print_system_message("❌ 用法: /undo [回合数]")
+            return
+
+        state = self.snapshots.undo(steps)
+        if state is None:
+            self.print_system_message(f"❌ 无法撤销 {steps} 个回合 (可撤销: {len(self.snapshots.snapshots)})")
+            return
+
+        self.game_state = state
+        self.print_system_message(f"⏪ 已撤销 {steps} 个回合，回到第 {state.turn} 回合: {state.location}")
+
+    def save_branch(self, args: list):
+        """处理 /save 名称"""
+        if not args:
+            self.print_system_message("❌ 用法: /save 名称")
+            return
+        name = " ".join(args)
+        self.snapshots.save_branch(name, self.game_state)
+        self.print_system_message(f"💾 已保存分支: {name} (第 {self.game_state.turn} 回合)")
+
+    def load_branch(self, args: list):
+        """处理 /load 名称"""
+        name = " ".join(args)
+        state = self.snapshots.load_branch(name)
+        if state is None:
+            self.print_system_message(f"❌ 分支不存在: {name}")
+            return
+        self.game_state = state
+        self.print_system_message(f"🔀 已切换到分支: {name} (第 {state.turn} 回合, {state.location})")
+
+    def show_branches(self):
+        """显示已保存的分支"""
+        if not self.snapshots.branches:
+            self.print_system_message("🔀 还没有保存的分支。使用 /save 名称 保存当前进度。")
+            return
+        lines = []
+        for name, (snapshot, _) in self.snapshots.branches.items():
+            fields = dict(snapshot[1])
+            lines.append(f"  {name}: 第 {fields['turn']} 回合, {fields['location']}")
+        self.print_system_message("🔀 已保存的分支:\n" + "\n".join(lines))
+
+    def toggle_speculation(self, args: list):
+        """处理 /speculate [on [token预算]/off]"""
+        option = args[0].lower() if args else ''
+        if option == 'on':
+            if not self.deepseek:
+                self.print_system_message("❌ 预测模式需要连接DeepSeek")
+                return
+            if len(args) > 1:
+                try:
+                    budget = int(args[1])
+                except ValueError:
+                    budget = 0
+                if budget <= 0:
+                    self.print_system_message("❌ token预算必须是正整数，例如 /speculate on 20000")
+                    return
+                self.speculative_token_budget = budget
+            if self.speculator:
+                self.speculator.token_budget = self.speculative_token_budget
+            else:
+                self.speculator = SpeculativeGenerator(self.deepseek, self.speculative_top_k,
+                                                       self.speculative_token_budget)
+            self.print_system_message(f"🔮 预测模式已开启，token预算 {self.speculative_token_budget}")
+            return
+        if option == 'off':
+            if self.speculator:
+                self.speculator.close()
+                self.speculator = None
+            self.print_system_message("🔮 预测模式已关闭")
+            return
+
+        if not self.speculator:
+            self.print_system_message("🔮 预测模式未开启，使用 /speculate on 开启")
+            return
+        stats = self.speculator.stats()
+        self.print_system_message(
+            f"🔮 预测: 发起 {stats['launched']}, 命中 {stats['hits']}, 未命中 {stats['misses']}, "
+            f"超出预算跳过 {stats['skipped_over_budget']}, token {stats['tokens_spent']}/{stats['token_budget']}")
+
+    def show_world_map(self):
+        """显示已探索的地点"""
+        graph = self.game_state.world_graph
+        print("\n" + "=" * 60)
+        self.print_colored(f"🗺️ 已探索的地点 ({len(graph)}/{graph.max_locations})", 'cyan')
+        print("=" * 60)
+
+        for name, node in graph.nodes.items():
+            marker = "📍" if name == self.game_state.location else "  "
+            print(f"{marker} {name} (到访 {node['visits']} 次)")
+            if node['exits']:
+                print(f"   出口: {', '.join(node['exits'])}")
+            if node['enemies']:
+                print(f"   敌人: {', '.join(node['enemies'])}")
+
+        print(f"\n缓存命中: {graph.hits}, 未命中: {graph.misses}")
+        print("=" * 60)
+
     def random_world_event(self):
         """随机世界事件"""
+        location = self.game_state.location
+        time_of_day = self.game_state.world_state['time_of_day']
+
+        if self.event_pool:
+            # 提前为当前地点和时间补充事件，生成在后台进行
+            self.event_pool.prefetch(location, time_of_day, self.game_state.world_state['weather'])
+
         if random.random() < 0.15:  # 15%概率触发
-            events = [
-                {
-                    'description': '天空中突然出现了一道绚丽的彩虹，你感到精神振奋。',
-                    'effects': {'mana': 10}
-                },
-                {
-                    'description': '一阵神秘的风吹过，带来了远方的消息和一些金币。',
-                    'effects': {'gold': 12}
-                },
-                {
-                    'description': '你听到远处传来神秘的钟声，感到内心更加坚定。',
-                    'effects': {'health': 8}
-                },
-                {
-                    'description': '一只美丽的蝴蝶落在你的肩膀上，然后飞向未知的方向。',
-                    'effects': {'intelligence': 1}
-                },
-                {
-                    'description': '地面上出现了一个小小的魔法光圈，你从中获得了一些力量。',
-                    'effects': {'strength': 1}
-                }
-            ]
+            event = self.event_pool.draw(location, time_of_day) if self.event_pool else None
+            if event is None:
+                event = random.choice(DEFAULT_WORLD_EVENTS)
 
-            event = random.choice(events)
-            time.sleep(1)
             self.print_system_message(f"🌟 世界事件: {event['description']}")
+
+            recent_events = self.game_state.world_state['recent_events']
+            recent_events.append(event['description'])
+            if len(recent_events) > 5:
+                del recent_events[0]
+
+            new_weather = event.get('weather')
+            old_weather = self.game_state.world_state['weather']
+            if new_weather and new_weather != old_weather:
+                self.game_state.world_state['weather'] = new_weather
+                self.print_system_message(f"🌤️ 天气变化: {old_weather} → {new_weather}")
+
             self.apply_effects(event['effects'])
 
+    def update_world_state(self):
+        """随机更新天气和时间"""
+        if random.random() < 0.12:
+            old_weather = self.game_state.world_state["weather"]
+            new_weather = random.choice(WEATHER_OPTIONS)
+            if new_weather != old_weather:
+                self.game_state.world_state["weather"] = new_weather
+                self.print_system_message(f"🌤️ 天气变化: {old_weather} → {new_weather}")
+
+            if random.random() < 0.4:
+                old_time = self.game_state.world_state["time_of_day"]
+                new_time = random.choice(TIME_OPTIONS)
+                if new_time != old_time:
+                    self.game_state.world_state["time_of_day"] = new_time
+                    self.print_system_message(f"⏰ 时间流逝: {old_time} → {new_time}")
+
+    def process_turn(self, action: str) -> Dict[str, Any]:
+        """处理一个回合的玩家行动，返回该回合的统计记录"""
+        self.snapshots.record(self.game_state)
+        self.game_state.turn += 1
+        self.game_state.last_action = action
+
+        self.turn_record = {
+            "session_id": self.session_id, "turn": self.game_state.turn, "created_at": time.time(),
+            "action": action, "model_called": False, "needs_roll": False, "prompt_tokens": 0,
+            "completion_tokens": 0, "fallback": False, "parse_failed": False
+        }
+        start = time.perf_counter()
+        try:
+            self.process_action_with_deepseek(action)
+        finally:
+            # 本回合未被take取走的预测（移动快捷处理、无模型等路径）已经过期
+            if self.speculator:
+                self.speculator.discard()
+            record, self.turn_record = self.turn_record, None
+            record["latency_ms"] = (time.perf_counter() - start) * 1000
+            record["location"] = self.game_state.location
+            record["died"] = self.game_state.health <= 0
+            if self.analytics:
+                self.analytics.record_turn(record)
+        return record
+
+    def advance_world(self):
+        """回合结束后推进世界：随机事件与天气、时间变化"""
+        self.random_world_event()
+        self.update_world_state()
+
     def run(self):
         """运行游戏主循环"""
         self.init_game()
@@ -733,6 +2279,11 @@ class IntelligentTextAdventureGame:
         while True:
             try:
                 print("\n" + "-" * 60)
+
+                # 玩家阅读和输入期间在后台预测下一步
+                if self.speculator and not self.speculator.pending:
+                    self.speculator.speculate(self)
+
                 action = input(f"🗡️  {self.game_state.character_name}想做什么？> ").strip()
 
                 if not action:
@@ -754,6 +2305,24 @@ class IntelligentTextAdventureGame:
                 elif action.lower() == '/story':
                     self.show_story_history()
                     continue
+                elif action.lower() == '/map':
+                    self.show_world_map()
+                    continue
+                elif action.lower().split()[0] == '/undo':
+                    self.undo_turns(action.split()[1:])
+                    continue
+                elif action.lower().split()[0] == '/save':
+                    self.save_branch(action.split()[1:])
+                    continue
+                elif action.lower().split()[0] == '/load':
+                    self.load_branch(action.split()[1:])
+                    continue
+                elif action.lower() == '/branches':
+                    self.show_branches()
+                    continue
+                elif action.lower().split()[0] == '/speculate':
+                    self.toggle_speculation(action.split()[1:])
+                    continue
                 elif action.lower() == '/roll':
                     roll = self.roll_d20()
                     if roll <= 5:
@@ -763,14 +2332,16 @@ class IntelligentTextAdventureGame:
                     else:
                         self.print_system_message(f"🎲 你投出了: {roll}")
                     continue
+                elif action.lower().startswith('/roll '):
+                    self.roll_expression(action.split()[1:])
+                    continue
+                elif action.lower() == '/odds':
+                    self.print_system_message(f"🎯 检定成功率(d20+属性调整值):\n{self.format_check_odds()}")
+                    continue
 
                 # 显示玩家行动
                 self.print_player_message(action)
 
-                # 更新游戏状态
-                self.game_state.turn += 1
-                self.game_state.last_action = action
-
                 # AI思考
                 if self.deepseek:
                     thinking_messages = [
@@ -786,7 +2357,7 @@ class IntelligentTextAdventureGame:
                 time.sleep(1.8)  # 增加悬念
 
                 # 处理行动
-                self.process_action_with_deepseek(action)
+                self.process_turn(action)
 
                 # 检查游戏结束条件
                 if self.game_state.health <= 0:
@@ -796,31 +2367,13 @@ class IntelligentTextAdventureGame:
                     if restart == 'y':
                         print("\n🔄 重新编织命运之线...")
                         time.sleep(2)
-                        self.game_state = GameState()
+                        self.game_state = self.new_game_state()
                         self.init_game()
                     else:
                         break
 
-                # 随机世界事件
-                self.random_world_event()
-
-                # 随机更新世界状态
-                if random.random() < 0.12:
-                    weather_options = ["晴朗", "多云", "小雨", "起雾", "微风", "星空闪烁"]
-                    time_options = ["黎明", "上午", "正午", "下午", "黄昏", "夜晚", "深夜"]
-
-                    old_weather = self.game_state.world_state["weather"]
-                    new_weather = random.choice(weather_options)
-                    if new_weather != old_weather:
-                        self.game_state.world_state["weather"] = new_weather
-                        self.print_system_message(f"🌤️ 天气变化: {old_weather} → {new_weather}")
-
-                    if random.random() < 0.4:
-                        old_time = self.game_state.world_state["time_of_day"]
-                        new_time = random.choice(time_options)
-                        if new_time != old_time:
-                            self.game_state.world_state["time_of_day"] = new_time
-                            self.print_system_message(f"⏰ 时间流逝: {old_time} → {new_time}")
+                # 世界状态推进
+                self.advance_world()
 
             except KeyboardInterrupt:
                 self.print_colored("\n\n🌟 感谢游玩！愿你的冒险传说永远流传在这个魔法世界中！", 'green')
@@ -829,6 +2382,15 @@ class IntelligentTextAdventureGame:
                 self.print_colored(f"❌ 发生错误: {e}", 'red')
                 print("游戏将继续运行...")
 
+        if self.event_pool and self.owns_event_pool:
+            self.event_pool.stop()
+        if self.speculator:
+            self.speculator.close()
+        if self.analytics and self.owns_analytics:
+            self.analytics.close()
+        if self.stat_store:
+            self.stat_store.release(self.game_state.slot)
+
 
 def get_deepseek_api_key():
     """获取DeepSeek API密钥"""
@@ -859,7 +2421,9 @@ if __name__ == "__main__":
     try:
         # 创建游戏实例
         print("\n🚀 正在启动游戏...")
-        game = IntelligentTextAdventureGame(api_key)
+        # 设置 GAME_ANALYTICS_DB 环境变量以记录战役数据
+        analytics_db = os.environ.get("GAME_ANALYTICS_DB")
+        game = IntelligentTextAdventureGame(api_key, analytics_db=analytics_db)
 
         # 运行游戏
         game.run()